@@ -0,0 +1,49 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import firebase_admin
+from firebase_admin import firestore
+
+import google.generativeai as genai
+
+# SDK clients are created once per process and shared by every importer.
+# Google clients authenticate with Application Default Credentials
+# (GOOGLE_APPLICATION_CREDENTIALS in production).
+
+# Load system prompt from file (once per process)
+SYSTEM_PROMPT = (
+    Path(__file__).with_name("studymate_prompt.txt").read_text(encoding="utf-8").strip()
+)
+
+# Initialize Gemini AI; the fixed StudyMate preamble is sent as the model's
+# system instruction so per-request prompts only carry the conversation.
+# Flash serves the common path; Pro is kept for long multi-step derivations.
+MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash-002")
+PRO_MODEL_NAME = os.getenv("GEMINI_PRO_MODEL", "gemini-1.5-pro-002")
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+model = genai.GenerativeModel(MODEL_NAME, system_instruction=SYSTEM_PROMPT)
+pro_model = genai.GenerativeModel(PRO_MODEL_NAME, system_instruction=SYSTEM_PROMPT)
+
+# Initialize Firebase (initialize_app raises if the default app already exists)
+try:
+    firebase_admin.get_app()
+except ValueError:
+    firebase_admin.initialize_app()
+db = firestore.client()
+
+
+# Google Vision and Speech clients are only needed for image and voice
+# messages, so their imports and channels are created on first use
+@lru_cache(maxsize=1)
+def vision_client():
+    from google.cloud import vision
+
+    return vision.ImageAnnotatorClient()
+
+
+@lru_cache(maxsize=1)
+def speech_client():
+    from google.cloud import speech_v1p1beta1 as speech
+
+    return speech.SpeechClient()
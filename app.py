@@ -1,23 +1,37 @@
 import os
-import json
+import atexit
+import hashlib
 import logging
+import logging.handlers
+import queue
+import re
+import threading
+import time
 from collections import deque
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
+import orjson
 import requests
+from cachetools import LRUCache, TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-import google.generativeai as genai
-from google.cloud import vision
-from google.cloud import speech_v1p1beta1 as speech
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s — %(message)s",
-)
+from firebase_admin import firestore
+
+import semantic_cache
+from _clients import db, model, pro_model, speech_client, vision_client
+
+# Configure logging: request and worker threads only enqueue records; a
+# listener thread formats them and writes to stderr
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s — %(message)s"))
+_log_queue = queue.SimpleQueue()
+_log_enqueue = logging.handlers.QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_log_enqueue])
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger("StudyMate")
 
 # Load environment variables
@@ -26,55 +40,212 @@ ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 PORT = int(os.getenv("PORT", 10000))
+# Upper bound on messages processed concurrently (Gemini/Graph/Firestore I/O)
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", 32))
+
+# Free-tier credits are refilled once per day
+DAILY_FREE_CREDITS = 20
+CREDIT_RESET_SECONDS = 24 * 60 * 60
 
 # Validate environment
 if not all([VERIFY_TOKEN, ACCESS_TOKEN, PHONE_NUMBER_ID, GEMINI_API_KEY]):
     logger.error("Missing required environment variables")
     raise SystemExit("Missing required environment variables")
 
-# Initialize Gemini AI
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-pro-002")
-
-# Initialize Firebase
-cred = credentials.Certificate(
-    "/etc/secrets/studymate-ai-9197f-firebase-adminsdk-fbsvc-5a52d9ff48.json"
+# Shared HTTP session so Graph API calls reuse keep-alive connections
+GRAPH_URL = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
+HTTP_TIMEOUT = (3, 10)  # (connect, read) seconds
+JSON_HEADERS = {"Content-Type": "application/json"}
+http_session = requests.Session()
+http_session.headers.update({"Authorization": f"Bearer {ACCESS_TOKEN}"})
+http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=50,
+        pool_maxsize=BACKGROUND_WORKERS,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Idempotent methods only: a 5xx on a send can follow a delivered
+            # message, and replaying the POST would send it twice
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        ),
+    ),
 )
-firebase_admin.initialize_app(cred)
-db = firestore.client()
 
-# Initialize Google Vision and Speech clients
-vision_client = vision.ImageAnnotatorClient()
-speech_client = speech.SpeechClient()
-
-# Load system prompt from file
-with open("studymate_prompt.txt", "r") as f:
-    SYSTEM_PROMPT = f.read().strip()
+# Shared read-only default for missing webhook objects
+_EMPTY = {}
+
+# Follow-up buttons sent after academic answers; shared read-only by every send.
+# An answer short enough for an interactive body carries the buttons itself.
+BUTTONS_PROMPT = "Did that make sense to you?"
+BUTTONS_ACTION = {
+    "buttons": [
+        {"type": "reply", "reply": {"id": "understood", "title": "Understood"}},
+        {"type": "reply", "reply": {"id": "explain_more", "title": "Explain more"}},
+    ]
+}
+BUTTONS_INTERACTIVE = {
+    "type": "button",
+    "body": {"text": BUTTONS_PROMPT},
+    "action": BUTTONS_ACTION,
+}
+INTERACTIVE_BODY_MAX_CHARS = 1024
+
+# Keywords that mark an answer as academic (follow-up buttons are offered);
+# only the opening ACADEMIC_SCAN_CHARS of an answer are searched
+ACADEMIC_KEYS = ("step-by-step", "essay", "project", "exam", "solution", "problem", "question")
+ACADEMIC_SCAN_CHARS = 4096
+_ACADEMIC_RE = re.compile("|".join(map(re.escape, ACADEMIC_KEYS)), re.IGNORECASE)
+
+# Questions escalated from the default (Flash) model to Pro
+PRO_MIN_CHARS = 400
+PRO_KEYWORDS = ("prove", "derive", "integrate")
+
+# User document fields read on every webhook; credits are read inside the
+# spend transaction and last_prompt is fetched lazily
+USER_FIELDS = ["name", "first_name", "account_type"]
+
+# Webhook dedup: WhatsApp message ids delivered in the last day
+SEEN_MESSAGES = TTLCache(maxsize=50000, ttl=24 * 60 * 60)
+seen_lock = threading.Lock()
+
+# Fast path: greetings and acknowledgements from known users get a canned
+# reply built from USER_SUMMARY (phone -> (first_name, account_type)), with
+# no Firestore reads or Gemini call
+CANNED_REPLY_MAX_CHARS = 12
+_GREETING_REPLY = "Hi {}! How can I help you study today?"
+_THANKS_REPLY = "You're welcome, {}! Send another question whenever you're ready."
+_NEXT_REPLY = "Great—what’s next?"
+CANNED_REPLIES = {
+    "hi": _GREETING_REPLY,
+    "hello": _GREETING_REPLY,
+    "hey": _GREETING_REPLY,
+    "thanks": _THANKS_REPLY,
+    "thank you": _THANKS_REPLY,
+    "ok": _NEXT_REPLY,
+    "okay": _NEXT_REPLY,
+    "cool": _NEXT_REPLY,
+    "nice": _NEXT_REPLY,
+    "bye": "Bye {}! Good luck with your studies.",
+}
+USER_SUMMARY = LRUCache(maxsize=100_000)
+user_summary_lock = threading.Lock()
+
+# User cache: phone -> user dict (a minute by default), kept in sync by update_user
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+USER_CACHE = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+user_cache_lock = threading.Lock()
+
+# Longest text message passed on to Gemini
+MAX_INPUT_CHARS = 5000
+
+# Media downloads: inline Vision/Speech requests are capped at 10 MB
+MAX_MEDIA_BYTES = 10 * 1024 * 1024
+MEDIA_CHUNK_BYTES = 64 * 1024
+
+
+# Raised by download_media when a file exceeds MAX_MEDIA_BYTES
+class MediaTooLarge(Exception):
+    pass
+
+
+# Failures fetching media from Graph (HTTP errors after retries, timeouts,
+# oversized files); anything else is a bug and is logged with its traceback
+MEDIA_FETCH_ERRORS = (requests.RequestException, MediaTooLarge)
+
+# Media cache: WhatsApp media id -> OCR text or transcript for five minutes
+MEDIA_CACHE = TTLCache(maxsize=256, ttl=5 * 60)
+media_cache_lock = threading.Lock()
+
+# Streaming: minimum content (chars) gathered before a partial answer is sent;
+# a paragraph longer than STREAM_SENTENCE_CHARS is split at its last sentence end.
+# At most STREAM_MAX_PARTS partial messages go out before the final remainder.
+STREAM_FLUSH_CHARS = 200
+STREAM_SENTENCE_CHARS = 600
+STREAM_MAX_PARTS = 1
+
+# Start of the "content" string in a (possibly partial) JSON reply
+_CONTENT_START_RE = re.compile(r'"content"\s*:\s*"')
+
+# Reply cleanup: body of a leading ``` fence, and a bare "json" header line
+_FENCED_RE = re.compile(r"```(.*?)```", re.DOTALL)
+_JSON_HEADER_RE = re.compile(r"[ \t]*json[ \t]*(?:\r?\n|\Z)", re.IGNORECASE)
+
+# Reply cache: blake2b(whitespace-normalized prompt) -> raw Gemini text for up to a day,
+# skipped for very long prompts
+REPLY_CACHE = TTLCache(maxsize=5000, ttl=24 * 60 * 60)
+REPLY_CACHE_MAX_PROMPT_BYTES = 16 * 1024
+reply_cache_lock = threading.Lock()
 
 # Create Flask app
 app = Flask(__name__)
-# Session storage: maps phone number to conversation history
-sessions = {}  # phone -> {"history": deque(maxlen=5)}
+# Background workers: Gemini, Graph and Firestore calls run off the request
+# thread. Each phone is pinned to one single-thread lane so a user's messages
+# are handled in order, while different users run concurrently.
+EXECUTORS = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"studymate-{i}")
+    for i in range(BACKGROUND_WORKERS)
+]
+# Side calls a message task does not wait for, such as cache writes; kept off
+# EXECUTORS so they never queue behind a user's next message
+IO_EXECUTOR = ThreadPoolExecutor(
+    max_workers=BACKGROUND_WORKERS, thread_name_prefix="studymate-io"
+)
+# Session storage: maps phone number to conversation history; a conversation
+# idle for SESSION_TTL starts over, and the least recent ones are dropped first
+SESSION_TTL = 60 * 60
+sessions = TTLCache(maxsize=100_000, ttl=SESSION_TTL)  # phone -> {"history": deque(maxlen=5)}
+sessions_lock = threading.Lock()
+
+
+# Helper: record a WhatsApp message id, returning True if it was already seen
+def seen_before(mid):
+    with seen_lock:
+        if mid in SEEN_MESSAGES:
+            return True
+        SEEN_MESSAGES[mid] = True
+        return False
+
 
+# Helper: the background lane that handles every message from a phone
+def executor_for(phone):
+    return EXECUTORS[hash(phone) % len(EXECUTORS)]
 
-# Helper: ensure session exists
+
+# Helper: run a side call on IO_EXECUTOR without waiting, logging any failure
+def fire_and_forget(fn, *args):
+    def _log_failure(future):
+        if future.exception() is not None:
+            logger.error("Background %s failed: %s", fn.__name__, future.exception())
+
+    IO_EXECUTOR.submit(fn, *args).add_done_callback(_log_failure)
+
+
+# Helper: remember who a phone number belongs to for the greeting fast path
+def remember_user(phone, first_name, account_type):
+    with user_summary_lock:
+        USER_SUMMARY[phone] = (first_name, account_type)
+
+
+# Helper: ensure session exists (re-storing it restarts the idle timer)
 def ensure_session(phone):
-    return sessions.setdefault(phone, {"history": deque(maxlen=5)})
+    with sessions_lock:
+        session = sessions.get(phone) or {"history": deque(maxlen=5)}
+        sessions[phone] = session
+    return session
 
 
 # Helper: send HTTP POST to WhatsApp API
 def safe_post(url, payload):
     try:
-        r = requests.post(
-            url,
-            headers={
-                "Authorization": f"Bearer {ACCESS_TOKEN}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
+        r = http_session.post(
+            url, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=HTTP_TIMEOUT
         )
         if r.status_code not in (200, 201):
-            logger.error(f"WhatsApp API error {r.status_code}: {r.text}")
+            logger.error("WhatsApp API error %s: %s", r.status_code, r.text)
         return r
     except Exception:
         logger.exception("Failed WhatsApp send")
@@ -89,8 +260,7 @@ def send_text(phone, text):
         "type": "text",
         "text": {"body": text},
     }
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    return safe_post(url, payload)
+    return safe_post(GRAPH_URL, payload)
 
 
 # Helper: send interactive buttons
@@ -99,51 +269,169 @@ def send_buttons(phone):
         "messaging_product": "whatsapp",
         "to": phone,
         "type": "interactive",
-        "interactive": {
-            "type": "button",
-            "body": {"text": "Did that make sense to you?"},
-            "action": {
-                "buttons": [
-                    {"type": "reply", "reply": {"id": "understood", "title": "Understood"}},
-                    {"type": "reply", "reply": {"id": "explain_more", "title": "Explain more"}},
-                ]
-            },
-        },
+        "interactive": BUTTONS_INTERACTIVE,
     }
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    return safe_post(url, payload)
+    return safe_post(GRAPH_URL, payload)
+
+
+# Helper: send an answer followed by the buttons, as a single interactive
+# message when the answer fits in its body
+def send_answer_with_buttons(phone, text):
+    body = f"{text}\n\n{BUTTONS_PROMPT}"
+    if not text or len(body) > INTERACTIVE_BODY_MAX_CHARS:
+        if text:
+            send_text(phone, text)
+        return send_buttons(phone)
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": phone,
+        "type": "interactive",
+        "interactive": {"type": "button", "body": {"text": body}, "action": BUTTONS_ACTION},
+    }
+    return safe_post(GRAPH_URL, payload)
+
+
+# Helper: true if s holds at least two whitespace-separated words; split stops
+# after the first separator, so long messages are not split into a word list
+def has_two_tokens(s):
+    return len(s.split(None, 1)) == 2
 
 
 # Helper: strip code fences and JSON header
 def strip_fences_and_header(text):
     t = text.strip()
-    if t.startswith("```"):
-        parts = t.split("```")
-        if len(parts) >= 3:
-            t = parts[1]
-    lines = t.splitlines()
-    if lines and lines[0].strip().lower() == "json":
-        lines = lines[1:]
-    return "\n".join(lines).strip()
+    m = _FENCED_RE.match(t)
+    if m:
+        t = m.group(1)
+    m = _JSON_HEADER_RE.match(t)
+    if m:
+        t = t[m.end():]
+    return t.strip()
+
+
+# Helper: reply-cache key for a prompt, or None if it is too long to cache
+def reply_cache_key(prompt):
+    # Runs of spaces inside a line should not defeat the cache, but newlines,
+    # leading indentation and case carry meaning in code and formulas
+    lines = []
+    for line in prompt.strip().splitlines():
+        body = line.lstrip()
+        lines.append(line[:len(line) - len(body)] + " ".join(body.split()))
+    encoded = "\n".join(lines).encode()
+    if len(encoded) > REPLY_CACHE_MAX_PROMPT_BYTES:
+        return None
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+
+# Helper: cached reply for a key, if any
+def cached_reply(key):
+    if key is None:
+        return None
+    with reply_cache_lock:
+        return REPLY_CACHE.get(key)
+
+
+# Helper: remember a successful reply
+def cache_reply(key, text):
+    if key is not None:
+        with reply_cache_lock:
+            REPLY_CACHE[key] = text
+
+
+# Helper: reply used when Gemini fails
+def gemini_error_reply():
+    return orjson.dumps({
+        "type": "clarification",
+        "content": "Sorry, I encountered an error. Please try again.",
+    }).decode()
+
+
+# Helper: pick the Gemini model for a question
+def pick_model(question):
+    if len(question) > PRO_MIN_CHARS:
+        return pro_model
+    lowered = question.lower()
+    return pro_model if any(k in lowered for k in PRO_KEYWORDS) else model
 
 
 # Helper: call Gemini with prompt
-def get_gemini(prompt):
+def get_gemini(prompt, gen_model=model):
+    key = reply_cache_key(prompt)
+    cached = cached_reply(key)
+    if cached is not None:
+        return cached
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        response = gen_model.generate_content(prompt)
+        text = response.text
     except Exception:
         logger.exception("Gemini API error")
-        return json.dumps({
-            "type": "clarification",
-            "content": "Sorry, I encountered an error. Please try again.",
-        })
+        return gemini_error_reply()
+    cache_reply(key, text)
+    return text
+
+
+# Helper: replace literal "\n" / "/n/" sequences the model sometimes emits
+def normalize_newlines(text):
+    return text.replace("\\n", "\n").replace("/n/", "\n")
+
+
+# Helper: call Gemini with streaming, sending the first finished paragraphs of
+# the reply's JSON "content" to the user as soon as they are generated.
+# Returns (raw reply, decoded content already sent).
+def stream_gemini(phone, prompt, gen_model=model):
+    key = reply_cache_key(prompt)
+    cached = cached_reply(key)
+    if cached is not None:
+        return cached, ""
+    raw = ""
+    sent = ""
+    parts = 0
+    content_start = None
+    try:
+        for chunk in gen_model.generate_content(prompt, stream=True):
+            raw += chunk.text
+            if parts >= STREAM_MAX_PARTS:
+                continue
+            if content_start is None:
+                m = _CONTENT_START_RE.search(raw)
+                if not m:
+                    continue
+                content_start = m.end()
+            # Paragraph breaks appear JSON-escaped inside the content string
+            body = raw[content_start:]
+            cut = body.rfind("\\n\\n")
+            if len(body) - cut > STREAM_SENTENCE_CHARS:
+                # Long paragraph still open: send up to its last finished sentence
+                sentence_end = max(body.rfind(". "), body.rfind("! "), body.rfind("? "))
+                if sentence_end > cut:
+                    cut = sentence_end + 1
+            if cut == -1:
+                continue
+            try:
+                text = orjson.loads('"' + body[:cut] + '"')
+            except ValueError:
+                continue
+            # Hold short paragraphs back so a reply is not split into many tiny messages
+            if len(text) - len(sent) < STREAM_FLUSH_CHARS:
+                continue
+            paragraph = normalize_newlines(text[len(sent):]).strip()
+            if paragraph:
+                send_text(phone, paragraph)
+                sent = text
+                parts += 1
+    except Exception:
+        logger.exception("Gemini API error")
+        return gemini_error_reply(), sent
+    cache_reply(key, raw)
+    return raw, sent
 
 
 # Helper: analyze image with Google Vision OCR
 def analyze_image_with_vision(image_bytes):
+    from google.cloud import vision
+
     image = vision.Image(content=image_bytes)
-    response = vision_client.text_detection(image=image)
+    response = vision_client().text_detection(image=image)
     texts = response.text_annotations
     if texts:
         return texts[0].description.strip()
@@ -153,23 +441,46 @@ def analyze_image_with_vision(image_bytes):
 # Helper: get media URL from WhatsApp
 def get_whatsapp_media_url(media_id):
     url = f"https://graph.facebook.com/v19.0/{media_id}"
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-    r = requests.get(url, headers=headers)
+    r = http_session.get(url, timeout=HTTP_TIMEOUT)
     r.raise_for_status()
     data = r.json()
     return data.get("url")
 
 
-# Helper: download binary media
+# Helper: download binary media, streamed so an oversized file is abandoned
+# before it is held in memory
 def download_media(url):
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    return r.content
+    with http_session.get(url, timeout=HTTP_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        if int(r.headers.get("Content-Length") or 0) > MAX_MEDIA_BYTES:
+            raise MediaTooLarge(url)
+        chunks = []
+        size = 0
+        for chunk in r.iter_content(MEDIA_CHUNK_BYTES):
+            size += len(chunk)
+            if size > MAX_MEDIA_BYTES:
+                raise MediaTooLarge(url)
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+# Helper: text extracted from a WhatsApp media id, cached so the same media is
+# not downloaded and sent to Vision/Speech again; empty results are not kept
+def media_text(media_id, extract):
+    with media_cache_lock:
+        text = MEDIA_CACHE.get(media_id)
+    if text is None:
+        text = extract(download_media(get_whatsapp_media_url(media_id)))
+        if text:
+            with media_cache_lock:
+                MEDIA_CACHE[media_id] = text
+    return text
 
 
 # Helper: transcribe audio (original logic)
 def transcribe_audio_with_speech(audio_bytes):
+    from google.cloud import speech_v1p1beta1 as speech
+
     try:
         audio = speech.RecognitionAudio(content=audio_bytes)
         config = speech.RecognitionConfig(
@@ -177,45 +488,112 @@ def transcribe_audio_with_speech(audio_bytes):
             language_code="en-US",
             audio_channel_count=1,
         )
-        response = speech_client.recognize(config=config, audio=audio)
+        response = speech_client().recognize(config=config, audio=audio)
         transcript = "".join(
             result.alternatives[0].transcript for result in response.results
         )
         return transcript.strip()
     except Exception as e:
-        logger.error(f"Speech recognition error: {e}")
+        logger.error("Speech recognition error: %s", e)
         return None
 
 
-# Helper: load or create user in Firestore
-def get_or_create_user(phone):
-    ref = db.collection("users").document(phone)
-    doc = ref.get()
-    if not doc.exists:
+# Helper: read user documents in one batchGet RPC, however many are needed.
+# Returns {phone: fields} for the documents that exist.
+def load_users(phones, field_paths=USER_FIELDS):
+    refs = [db.collection("users").document(phone) for phone in phones]
+    docs = db.get_all(refs, field_paths=field_paths)
+    return {doc.id: doc.to_dict() or {} for doc in docs if doc.exists}
+
+
+# Helper: load or create user in Firestore (hot-path fields only), served from
+# USER_CACHE while the entry is fresh. A new user's document is staged in
+# pending_updates so it is written in the same commit as the rest of the turn.
+def get_or_create_user(phone, pending_updates):
+    with user_cache_lock:
+        user = USER_CACHE.get(phone)
+    if user is not None:
+        return user
+    user = load_users([phone]).get(phone)
+    if user is None:
         user = {
             "phone": phone,
             "name": None,
             "account_type": "free",
-            "credit_remaining": 20,
-            "credit_reset": datetime.utcnow() + timedelta(days=1),
+            "credit_remaining": DAILY_FREE_CREDITS,
+            "credit_reset": int(time.time()) + CREDIT_RESET_SECONDS,
             "last_prompt": None,
         }
-        ref.set(user)
-        return user
-    return doc.to_dict()
+        pending_updates.update(user)
+    with user_cache_lock:
+        USER_CACHE[phone] = user
+    return user
+
+
+# Helper: fetch the stored prompt for "Explain more" on demand
+def get_last_prompt(phone):
+    return load_users([phone], ["last_prompt"]).get(phone, {}).get("last_prompt")
+
+
+# Helper: spend one free credit atomically, refilling first if the day rolled over.
+# Returns the credits left, or None when the daily limit is exhausted.
+@firestore.transactional
+def _spend_credit(transaction, ref, now_ts):
+    snap = ref.get(field_paths=["credit_remaining", "credit_reset"], transaction=transaction)
+    data = snap.to_dict() or {}
+    reset_ts = data.get("credit_reset") or 0
+    legacy = hasattr(reset_ts, "timestamp")
+    if legacy:
+        # Legacy documents store a Firestore timestamp instead of epoch seconds
+        reset_ts = int(reset_ts.timestamp())
+    if now_ts >= reset_ts:
+        transaction.update(ref, {
+            "credit_remaining": DAILY_FREE_CREDITS - 1,
+            "credit_reset": now_ts + CREDIT_RESET_SECONDS,
+        })
+        return DAILY_FREE_CREDITS - 1
+    remaining = data.get("credit_remaining", 0)
+    if remaining <= 0:
+        return None
+    fields = {"credit_remaining": firestore.Increment(-1)}
+    if legacy:
+        # Migrate to epoch seconds in the write this spend makes anyway
+        fields["credit_reset"] = reset_ts
+    transaction.update(ref, fields)
+    return remaining - 1
 
 
-# Helper: update user fields
-def update_user(phone, **fields):
-    db.collection("users").document(phone).update(fields)
-    logger.info(f"Updated user {phone} with {fields}")
+def spend_credit(phone, now_ts):
+    return _spend_credit(db.transaction(), db.collection("users").document(phone), now_ts)
 
 
-# Helper: build system prompt for Gemini
+# Helper: write user fields in a single batched commit (merge creates the
+# document on a new user's first turn)
+def update_user(phone, fields):
+    batch = db.batch()
+    batch.set(db.collection("users").document(phone), fields, merge=True)
+    try:
+        batch.commit()
+    except Exception:
+        # Drop the cached copy so the next turn re-reads what actually landed
+        with user_cache_lock:
+            USER_CACHE.pop(phone, None)
+        raise
+    # Write through so the cached copy stays authoritative until it expires
+    with user_cache_lock:
+        cached = USER_CACHE.get(phone)
+        if cached is not None:
+            cached.update(fields)
+    logger.debug("Updated user %s with %s", phone, fields)
+
+
+# Helper: build the per-request prompt (the system prompt lives on the model).
+# The user's name line is built once and memoized on the cached user dict.
 def build_prompt(user, history, message, first_name):
-    parts = [SYSTEM_PROMPT]
-    if first_name:
-        parts.append(f'User name: "{first_name}"')
+    name_line = user.get("_name_line")
+    if name_line is None:
+        name_line = user["_name_line"] = f'User name: "{first_name}"' if first_name else ""
+    parts = [name_line] if name_line else []
     if history:
         parts.append("Recent messages:")
         parts.extend(f"- {h}" for h in history)
@@ -236,48 +614,97 @@ def webhook():
         return "Verification failed", 403
 
     # POST: handle incoming message
-    data = request.json or {}
-    entry = data.get("entry", [])
-    if not entry or not entry[0].get("changes"):
+    try:
+        data = orjson.loads(request.get_data(cache=False) or b"{}")
+    except orjson.JSONDecodeError:
+        return "Bad JSON", 400
+    entries = data.get("entry") or ()
+    if not entries:
         return "OK", 200
-
-    msg = entry[0]["changes"][0]["value"].get("messages", [{}])[0]
+    changes = entries[0].get("changes") or ()
+    if not changes:
+        return "OK", 200
+    value = changes[0].get("value") or _EMPTY
+    messages = value.get("messages") or ()
+    if not messages:
+        # Status updates (sent/delivered/read) carry no messages
+        return "OK", 200
+    msg = messages[0]
     phone = msg.get("from")
     if not phone:
         return "OK", 200
 
+    # Meta redelivers until it gets a 200; only the first delivery is processed
+    mid = msg.get("id")
+    if mid and seen_before(mid):
+        return "OK", 200
+
+    # Acknowledge Meta immediately; the reply is produced in the background
+    executor_for(phone).submit(process_message, phone, msg)
+    return "OK", 200
+
+
+# Background task: handle a message and write staged user changes in one commit
+def process_message(phone, msg):
+    pending_updates = {}
+    try:
+        try:
+            handle_message(phone, msg, pending_updates)
+        finally:
+            if pending_updates:
+                update_user(phone, pending_updates)
+    except Exception:
+        logger.exception("Failed to process message from %s", phone)
+
+
+# Process one inbound WhatsApp message, staging user changes in pending_updates
+def handle_message(phone, msg, pending_updates):
+    # --- Greeting or acknowledgement from a known user: canned reply ---
+    if msg.get("type") == "text":
+        text_body = msg["text"]["body"].strip()
+        if len(text_body) <= CANNED_REPLY_MAX_CHARS:
+            reply = CANNED_REPLIES.get(text_body.lower().rstrip(".!? "))
+            if reply:
+                with user_summary_lock:
+                    summary = USER_SUMMARY.get(phone)
+                if summary:
+                    send_text(phone, reply.format(summary[0]))
+                    return
+        # Oversized pastes are turned away before they cost a credit or tokens
+        elif len(text_body) > MAX_INPUT_CHARS:
+            send_text(phone, "That message is too long for me. Please send just the question you need help with.")
+            return
+
     # Load or init user
-    user = get_or_create_user(phone)
+    user = get_or_create_user(phone, pending_updates)
     session = ensure_session(phone)
     history = list(session["history"])
-    now = datetime.utcnow()
-    first_name = user.get("name", "").split()[0] if user.get("name") else ""
+    now_ts = int(time.time())
+    first_name = user.get("first_name") or (
+        user["name"].split(None, 1)[0] if user.get("name") else ""
+    )
+    if first_name:
+        remember_user(phone, first_name, user.get("account_type"))
 
     # --- Onboarding: collect full name ---
     if user.get("name") is None:
         text_body = msg.get("text", {}).get("body", "").strip()
-        if text_body and len(text_body.split()) >= 2:
-            first = text_body.split()[0]
-            update_user(phone, name=text_body)
+        if has_two_tokens(text_body):
+            first = text_body.split(None, 1)[0]
+            pending_updates.update(name=text_body, first_name=first)
+            remember_user(phone, first, user.get("account_type"))
             send_text(phone, f"What would you like to study today, {first}?")
         else:
             send_text(phone, "Please share your full name (first and last).")
-        return "OK", 200
+        return
 
     # --- Free account credit handling ---
     if user.get("account_type") == "free":
-        reset_time = user.get("credit_reset")
-        if hasattr(reset_time, "to_datetime"):
-            reset_time = reset_time.to_datetime()
-        if isinstance(reset_time, datetime) and reset_time.tzinfo:
-            reset_time = reset_time.replace(tzinfo=None)
-        if now >= reset_time:
-            update_user(phone, credit_remaining=20, credit_reset=now + timedelta(days=1))
-            user["credit_remaining"] = 20
-        if user.get("credit_remaining", 0) <= 0:
+        remaining = spend_credit(phone, now_ts)
+        if remaining is None:
             send_text(phone, "Free limit reached (20/day). Upgrade for unlimited usage.")
-            return "OK", 200
-        update_user(phone, credit_remaining=user.get("credit_remaining") - 1)
+            return
+        user["credit_remaining"] = remaining
 
     # --- Interactive button replies ---
     if msg.get("type") == "interactive":
@@ -286,12 +713,13 @@ def webhook():
             bid = ir["button_reply"]["id"]
             if bid == "understood":
                 send_text(phone, "Great—what’s next?")
-            elif bid == "explain_more" and user.get("last_prompt"):
-                more = get_gemini(user.get("last_prompt") + "\n\nPlease explain in more detail.")
-                refined = strip_fences_and_header(more)
-                send_text(phone, refined)
-                send_buttons(phone)
-        return "OK", 200
+            elif bid == "explain_more":
+                last_prompt = get_last_prompt(phone)
+                if last_prompt:
+                    more = get_gemini(last_prompt + "\n\nPlease explain in more detail.")
+                    refined = strip_fences_and_header(more)
+                    send_answer_with_buttons(phone, refined)
+        return
 
     # --- Handle different message types ---
     if msg.get("type") == "text":
@@ -301,32 +729,35 @@ def webhook():
     elif msg.get("type") == "image":
         media_id = msg["image"]["id"]
         try:
-            media_url = get_whatsapp_media_url(media_id)
-            image_bytes = download_media(media_url)
-            extracted = analyze_image_with_vision(image_bytes)
+            extracted = media_text(media_id, analyze_image_with_vision)
             gemini_input = extracted or "I received an image but couldn't extract text. Please describe it."
-        except Exception as e:
-            logger.error(f"Image processing error: {e}")
+        except MEDIA_FETCH_ERRORS as e:
+            logger.warning("Image download failed for %s: %s", media_id, e)
+            gemini_input = "Sorry, I had trouble processing your image. Please try again."
+        except Exception:
+            logger.exception("Image processing error")
             gemini_input = "Sorry, I had trouble processing your image. Please try again."
 
     elif msg.get("type") == "audio":
         media_id = msg["audio"]["id"]
         try:
-            media_url = get_whatsapp_media_url(media_id)
-            audio_bytes = download_media(media_url)
-            transcript = transcribe_audio_with_speech(audio_bytes)
+            transcript = media_text(media_id, transcribe_audio_with_speech)
             if transcript:
                 gemini_input = transcript
             else:
                 gemini_input = "Sorry, I couldn't understand the audio. Please try again."
-        except Exception as e:
-            logger.error(f"Audio processing error: {e}")
+        except MEDIA_FETCH_ERRORS as e:
+            logger.warning("Audio download failed for %s: %s", media_id, e)
+            send_text(phone, f"No worries, {first_name}! What can I help you with next?")
+            return
+        except Exception:
+            logger.exception("Audio processing error")
             send_text(phone, f"No worries, {first_name}! What can I help you with next?")
-            return "OK", 200
+            return
 
     else:
         # Unsupported message type
-        return "OK", 200
+        return
 
     # Append user input to session history
     session["history"].append(gemini_input)
@@ -334,36 +765,49 @@ def webhook():
     # Build Gemini prompt
     prompt = build_prompt(user, history, gemini_input, first_name)
 
-    # Call Gemini
-    raw_response = get_gemini(prompt)
-    logger.info(f"Gemini raw response:\n{raw_response}")
+    # Call Gemini, reusing the answer to a near-identical fresh text question.
+    # The lookup is a paid embedding round trip, so it runs only here, after
+    # the credit check and for questions no other step has answered
+    raw_response, question_vec = None, None
+    if msg.get("type") == "text" and not history:
+        raw_response, question_vec = semantic_cache.lookup(gemini_input)
+    sent = ""
+    if raw_response is None:
+        raw_response, sent = stream_gemini(phone, prompt, pick_model(gemini_input))
+    logger.debug("Gemini raw response:\n%s", raw_response)
     cleaned = strip_fences_and_header(raw_response)
 
     # Try JSON parse
     try:
-        parsed = json.loads(cleaned)
+        parsed = orjson.loads(cleaned)
         rtype = parsed.get("type", "answer")
         content = parsed.get("content", "")
     except Exception:
         rtype = "answer"
         content = cleaned
 
-    # Normalize newlines
+    # Work out what the stream has not delivered yet
+    rest = content
     if isinstance(content, str):
-        content = content.replace("\\n", "\n").replace("/n/", "\n")
+        if sent and content.startswith(sent):
+            rest = content[len(sent):]
+        content = normalize_newlines(content)
+        rest = normalize_newlines(rest).strip()
 
-    # Send reply content
-    send_text(phone, content)
+    is_answer = rtype == "answer" and isinstance(content, str) and content != ""
 
-    # Send interactive buttons after academic answers
-    academic_keys = ["step-by-step", "essay", "project", "exam", "solution", "problem", "question"]
-    if rtype == "answer" and any(k in content.lower() for k in academic_keys):
-        send_buttons(phone)
+    # Academic answers end with the interactive buttons
+    if is_answer and _ACADEMIC_RE.search(content, 0, ACADEMIC_SCAN_CHARS):
+        send_answer_with_buttons(phone, rest)
+    elif rest:
+        send_text(phone, rest)
 
-    # Update last prompt for explain_more
-    update_user(phone, last_prompt=prompt)
+    # Cache generic answers only; personalized replies must not leak to others
+    if question_vec is not None and is_answer and not (first_name and first_name.lower() in content.lower()):
+        fire_and_forget(semantic_cache.store, gemini_input, raw_response, question_vec)
 
-    return "OK", 200
+    # Update last prompt for explain_more
+    pending_updates["last_prompt"] = prompt
 
 
 if __name__ == "__main__":
@@ -0,0 +1,16 @@
+import os
+
+# Production server settings (render.yaml: gunicorn app:app -c gunicorn.conf.py)
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# gthread workers keep client connections alive between webhook deliveries.
+# The in-process caches (user docs, replies, seen message ids) are per worker,
+# so scale threads before workers.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+keepalive = 75
+
+# No preload_app: app.py starts executor, log-listener and gRPC client threads
+# at import, and none of them survive a fork into the workers.
+preload_app = False
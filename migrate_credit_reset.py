@@ -0,0 +1,32 @@
+"""One-off backfill: rewrite legacy Firestore-timestamp credit_reset values
+as integer epoch seconds so the webhook only ever compares integers.
+
+Run once with the same credentials as the app: python migrate_credit_reset.py
+"""
+from _clients import db
+
+BATCH_SIZE = 400  # Firestore allows at most 500 writes per batch
+
+
+def migrate():
+    batch = db.batch()
+    pending = 0
+    migrated = 0
+    for doc in db.collection("users").select(["credit_reset"]).stream():
+        reset = (doc.to_dict() or {}).get("credit_reset")
+        if not hasattr(reset, "timestamp"):
+            continue
+        batch.update(doc.reference, {"credit_reset": int(reset.timestamp())})
+        pending += 1
+        migrated += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"Migrated {migrate()} user documents")
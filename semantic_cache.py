@@ -0,0 +1,158 @@
+import bisect
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import google.generativeai as genai
+
+logger = logging.getLogger("StudyMate")
+
+# Near-duplicate question cache: questions are embedded with Gemini and the
+# stored answer is reused when cosine similarity clears the threshold.
+# Point SEMANTIC_CACHE_DB at a persistent disk so the cache survives restarts
+CACHE_DB = os.getenv("SEMANTIC_CACHE_DB", "cache.db")
+EMBED_MODEL = "models/text-embedding-004"
+SIMILARITY_THRESHOLD = 0.92
+TTL_SECONDS = 30 * 24 * 60 * 60
+# Entries kept in memory (2000 x 768-dim float32 is about 6 MB); the oldest
+# tenth is evicted when the cache is full
+MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 2000))
+INITIAL_CAPACITY = 256
+
+# Numbers, operators and single-letter symbols must match exactly for a hit:
+# embeddings barely separate "2x + 3 = 7" from "2x + 3 = 9"
+_SYMBOL_RE = re.compile(
+    r"\d+(?:\.\d+)?|[=+\-*/^<>%()]"
+    r"|(?<![A-Za-z])[A-Za-z](?![A-Za-z])(?=\s?[\d=+\-*/^<>%()])"
+    r"|(?<=[\d=+\-*/^<>%()])[A-Za-z](?![A-Za-z])"
+    r"|(?<=[\d=+\-*/^<>%()] )[A-Za-z](?![A-Za-z])"
+)
+
+_lock = threading.Lock()
+_conn = None
+# Entries in insertion order (so timestamps ascend); row i of _matrix is the
+# L2-normalized float32 embedding for _answers[i], whose question had symbol
+# signature _signatures[i]. _matrix is a buffer that doubles when full, so only
+# its first len(_answers) rows are live.
+_answers = []
+_signatures = []
+_timestamps = []
+_matrix = None
+
+
+# Helper: open the SQLite store and load unexpired entries into memory
+def _load():
+    global _conn
+    _conn = sqlite3.connect(CACHE_DB, check_same_thread=False)
+    _conn.execute(
+        "CREATE TABLE IF NOT EXISTS qcache ("
+        "id INTEGER PRIMARY KEY, question TEXT, answer TEXT, embedding BLOB, ts INTEGER)"
+    )
+    _conn.execute("DELETE FROM qcache WHERE ts < ?", (int(time.time()) - TTL_SECONDS,))
+    _conn.execute(
+        "DELETE FROM qcache WHERE id NOT IN (SELECT id FROM qcache ORDER BY id DESC LIMIT ?)",
+        (MAX_ENTRIES,),
+    )
+    _conn.commit()
+    rows = _conn.execute(
+        "SELECT question, answer, embedding, ts FROM qcache ORDER BY id"
+    ).fetchall()
+    for question, answer, blob, ts in rows:
+        _append(_signature(question), answer, np.frombuffer(blob, dtype=np.float32), ts)
+
+
+# Helper: the numbers, operators and symbols in a question, in order
+def _signature(question):
+    return tuple(_SYMBOL_RE.findall(question))
+
+
+# Helper: add an entry, doubling the matrix buffer when it is full
+def _append(signature, answer, vec, ts):
+    global _matrix
+    n = len(_answers)
+    if _matrix is None:
+        _matrix = np.empty((min(INITIAL_CAPACITY, MAX_ENTRIES), vec.shape[0]), dtype=np.float32)
+    elif n == _matrix.shape[0]:
+        grown = np.empty((min(2 * n, MAX_ENTRIES), _matrix.shape[1]), dtype=np.float32)
+        grown[:n] = _matrix[:n]
+        _matrix = grown
+    _matrix[n] = vec
+    _signatures.append(signature)
+    _answers.append(answer)
+    _timestamps.append(ts)
+
+
+# Helper: forget the k oldest entries in memory
+def _drop_oldest(k):
+    n = len(_answers)
+    _matrix[:n - k] = _matrix[k:n]
+    del _signatures[:k]
+    del _answers[:k]
+    del _timestamps[:k]
+
+
+# Helper: drop entries past the TTL from memory and the database
+def _expire(now):
+    cutoff = now - TTL_SECONDS
+    k = bisect.bisect_left(_timestamps, cutoff)
+    if k:
+        _drop_oldest(k)
+        _conn.execute("DELETE FROM qcache WHERE ts < ?", (cutoff,))
+        _conn.commit()
+
+
+# Helper: embed a question as a unit-length float32 vector
+def _embed(question):
+    result = genai.embed_content(
+        model=EMBED_MODEL, content=question, task_type="semantic_similarity"
+    )
+    vec = np.asarray(result["embedding"], dtype=np.float32)
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+
+# Look up a cached answer. Returns (answer, None) on a hit, (None, vector) on a
+# miss so the caller can store() the new answer, and (None, None) on errors.
+def lookup(question):
+    try:
+        vec = _embed(question)
+    except Exception:
+        logger.exception("Embedding error")
+        return None, None
+    with _lock:
+        if _conn is None:
+            _load()
+        _expire(time.time())
+        n = len(_answers)
+        if n:
+            scores = _matrix[:n] @ vec
+            signature = _signature(question)
+            candidates = np.flatnonzero(scores > SIMILARITY_THRESHOLD)
+            for i in candidates[np.argsort(-scores[candidates])]:
+                if _signatures[i] == signature:
+                    return _answers[i], None
+    return None, vec
+
+
+# Store an answer for a question embedded by lookup()
+def store(question, answer, vec):
+    ts = int(time.time())
+    with _lock:
+        if _conn is None:
+            _load()
+        _expire(ts)
+        if len(_answers) >= MAX_ENTRIES:
+            k = max(1, MAX_ENTRIES // 10)
+            _drop_oldest(k)
+            _conn.execute(
+                "DELETE FROM qcache WHERE id IN (SELECT id FROM qcache ORDER BY id LIMIT ?)", (k,)
+            )
+        _conn.execute(
+            "INSERT INTO qcache (question, answer, embedding, ts) VALUES (?, ?, ?, ?)",
+            (question, answer, vec.tobytes(), ts),
+        )
+        _conn.commit()
+        _append(_signature(question), answer, vec, ts)
@@ -1,6 +1,8 @@
 import json
+from types import SimpleNamespace
 import pytest
-from app import app
+import app as studymate
+from app import app, has_two_tokens, reply_cache_key, seen_before, strip_fences_and_header
 
 @pytest.fixture
 def client():
@@ -29,6 +31,185 @@ def test_webhook_empty(client):
     assert resp.status_code == 200
     assert resp.get_data(as_text=True) == "OK"
 
+def test_webhook_bad_json(client):
+    resp = client.post("/webhook", data="{not json", content_type="application/json")
+    assert resp.status_code == 400
+
+def test_has_two_tokens():
+    assert has_two_tokens("Ada Lovelace")
+    assert has_two_tokens("  Ada   Lovelace  ")
+    assert has_two_tokens("Ada\tLovelace")
+    assert not has_two_tokens("Ada")
+    assert not has_two_tokens("Ada ")
+    assert not has_two_tokens("")
+
+def test_seen_before():
+    assert not seen_before("wamid.test-dedup")
+    assert seen_before("wamid.test-dedup")
+
+def test_strip_fences_and_header():
+    assert strip_fences_and_header('```json\n{"a": 1}\n```') == '{"a": 1}'
+    assert strip_fences_and_header('JSON\n{"a": 1}') == '{"a": 1}'
+    assert strip_fences_and_header('  {"a": 1}  ') == '{"a": 1}'
+    assert strip_fences_and_header('```json\n{"a": 1}') == '```json\n{"a": 1}'
+
+def test_reply_cache_key_keeps_case():
+    assert reply_cache_key('Current message: "What is Co?"') != reply_cache_key('Current message: "What is CO?"')
+    assert reply_cache_key("a  b \n c\n") == reply_cache_key("a b\n c")
+
+def test_reply_cache_key_keeps_indentation():
+    inside = "for i in range(3):\n    total += i\n    print('done')"
+    outside = "for i in range(3):\n    total += i\nprint('done')"
+    assert reply_cache_key(inside) != reply_cache_key(outside)
+    assert reply_cache_key("a\nb") != reply_cache_key("a b")
+
+def test_messages_from_one_phone_share_a_lane():
+    lane = studymate.executor_for("15550000020")
+    assert lane is studymate.executor_for("15550000020")
+    assert lane._max_workers == 1
+
+@pytest.fixture
+def sent(monkeypatch):
+    posts = []
+    monkeypatch.setattr(studymate, "safe_post", lambda url, payload: posts.append(payload))
+    return posts
+
+@pytest.fixture
+def user(monkeypatch):
+    profile = {"name": "Ada Lovelace", "first_name": "Ada", "account_type": "premium"}
+    monkeypatch.setattr(studymate, "get_or_create_user", lambda phone, pending: profile)
+    return profile
+
+class FakeBatch:
+    def __init__(self, writes):
+        self.writes = writes
+
+    def set(self, ref, fields, merge=False):
+        self.writes.append((ref.id, dict(fields), merge))
+
+    def commit(self):
+        pass
+
+def fake_db(writes):
+    collection = SimpleNamespace(document=lambda doc_id: SimpleNamespace(id=doc_id))
+    return SimpleNamespace(batch=lambda: FakeBatch(writes), collection=lambda name: collection)
+
+def test_new_user_document_written(monkeypatch, sent):
+    writes = []
+    monkeypatch.setattr(studymate, "db", fake_db(writes))
+    monkeypatch.setattr(studymate, "load_users", lambda phones, field_paths=None: {})
+    msg = {"type": "text", "text": {"body": "Ada Lovelace"}}
+    studymate.process_message("15550000010", msg)
+    assert sent[-1]["text"]["body"] == "What would you like to study today, Ada?"
+    [(doc_id, fields, merge)] = writes
+    assert doc_id == "15550000010" and merge
+    assert fields["phone"] == "15550000010"
+    assert fields["name"] == "Ada Lovelace" and fields["first_name"] == "Ada"
+    assert fields["account_type"] == "free"
+    assert studymate.USER_CACHE["15550000010"]["name"] == "Ada Lovelace"
+
+def test_extractor_error_is_logged_with_traceback(monkeypatch, sent, user):
+    def broken_ocr(image_bytes):
+        raise ValueError("unexpected response shape")
+
+    logged = []
+    monkeypatch.setattr(studymate, "get_whatsapp_media_url", lambda media_id: "https://media")
+    monkeypatch.setattr(studymate, "download_media", lambda url: b"img")
+    monkeypatch.setattr(studymate, "analyze_image_with_vision", broken_ocr)
+    monkeypatch.setattr(studymate, "stream_gemini", lambda phone, prompt, gen_model: ('{"content": "ok"}', ""))
+    monkeypatch.setattr(studymate.logger, "exception", lambda msg, *args: logged.append(msg))
+    monkeypatch.setattr(studymate.logger, "warning", lambda msg, *args: pytest.fail("logged as a fetch failure"))
+    msg = {"type": "image", "image": {"id": "media-extractor-error"}}
+    studymate.handle_message("15550000001", msg, {})
+    assert logged == ["Image processing error"]
+
+def test_exhausted_free_user_skips_embedding(monkeypatch, sent, user):
+    user["account_type"] = "free"
+    monkeypatch.setattr(studymate, "spend_credit", lambda phone, now_ts: None)
+    looked_up = []
+    monkeypatch.setattr(studymate.semantic_cache, "lookup", looked_up.append)
+    msg = {"type": "text", "text": {"body": "What is osmosis?"}}
+    studymate.handle_message("15550000002", msg, {})
+    assert sent[-1]["text"]["body"].startswith("Free limit reached")
+    assert looked_up == []
+
+class FakeModel:
+    def __init__(self, content, piece=40):
+        raw = json.dumps({"type": "answer", "content": content})
+        self.pieces = [raw[i:i + piece] for i in range(0, len(raw), piece)]
+
+    def generate_content(self, prompt, stream=False):
+        return [SimpleNamespace(text=p) for p in self.pieces]
+
+def test_stream_holds_short_paragraphs_and_caps_parts(sent):
+    first = "Cells divide by mitosis. " * 12
+    content = "Hi.\n\n" + first + "\n\n" + "Then they grow. " * 20 + "\n\nDone."
+    raw, streamed = studymate.stream_gemini("15550000003", "stream-parts", FakeModel(content))
+    assert json.loads(raw)["content"] == content
+    assert [p["text"]["body"] for p in sent] == ["Hi.\n\n" + first.strip()]
+    assert content.startswith(streamed)
+
+def test_stream_splits_long_paragraph_at_sentence_end(sent):
+    content = "Sentence number one is here. " * 30
+    _, streamed = studymate.stream_gemini("15550000004", "stream-sentences", FakeModel(content))
+    assert len(sent) == 1
+    first = sent[0]["text"]["body"]
+    assert first.endswith("here.") and content.startswith(first)
+    assert studymate.STREAM_FLUSH_CHARS <= len(first) < len(content.strip())
+
+def test_answer_with_buttons_single_message(sent):
+    studymate.send_answer_with_buttons("15550000005", "Short answer.")
+    assert len(sent) == 1
+    interactive = sent[0]["interactive"]
+    assert interactive["body"]["text"] == "Short answer.\n\n" + studymate.BUTTONS_PROMPT
+    assert interactive["action"] is studymate.BUTTONS_ACTION
+
+def test_answer_with_buttons_falls_back_when_too_long(sent):
+    text = "x" * studymate.INTERACTIVE_BODY_MAX_CHARS
+    studymate.send_answer_with_buttons("15550000005", text)
+    assert sent[0]["text"]["body"] == text
+    assert sent[1]["interactive"] is studymate.BUTTONS_INTERACTIVE
+    sent.clear()
+    studymate.send_answer_with_buttons("15550000005", "")
+    assert len(sent) == 1 and sent[0]["interactive"] is studymate.BUTTONS_INTERACTIVE
+
+class FakeMediaResponse:
+    def __init__(self, body, length=None):
+        self.body = body
+        self.headers = {} if length is None else {"Content-Length": str(length)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+def fake_media_session(response):
+    return SimpleNamespace(get=lambda url, **kwargs: response)
+
+def test_download_media_joins_chunks(monkeypatch):
+    monkeypatch.setattr(studymate, "MEDIA_CHUNK_BYTES", 4)
+    monkeypatch.setattr(studymate, "http_session", fake_media_session(FakeMediaResponse(b"0123456789", 10)))
+    assert studymate.download_media("https://media") == b"0123456789"
+
+def test_download_media_size_cap(monkeypatch):
+    monkeypatch.setattr(studymate, "MAX_MEDIA_BYTES", 8)
+    monkeypatch.setattr(studymate, "MEDIA_CHUNK_BYTES", 4)
+    monkeypatch.setattr(studymate, "http_session", fake_media_session(FakeMediaResponse(b"0123456789", 10)))
+    with pytest.raises(studymate.MediaTooLarge):
+        studymate.download_media("https://media")
+    # Without Content-Length the cap is enforced while streaming
+    monkeypatch.setattr(studymate, "http_session", fake_media_session(FakeMediaResponse(b"0123456789")))
+    with pytest.raises(studymate.MediaTooLarge):
+        studymate.download_media("https://media")
+
 @pytest.mark.parametrize("ex", load_examples())
 def test_academic_flow(client, ex):
     payload = make_payload(ex["question"])
@@ -0,0 +1,72 @@
+import time
+import numpy as np
+import pytest
+import semantic_cache
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(semantic_cache, "CACHE_DB", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(semantic_cache, "_conn", None)
+    monkeypatch.setattr(semantic_cache, "_answers", [])
+    monkeypatch.setattr(semantic_cache, "_signatures", [])
+    monkeypatch.setattr(semantic_cache, "_timestamps", [])
+    monkeypatch.setattr(semantic_cache, "_matrix", None)
+    vectors = {
+        "explain photosynthesis": [1.0, 0.0],
+        "how does photosynthesis work": [0.99, 0.05],
+        "solve 2x + 3 = 7": [0.0, 1.0],
+        "Solve 2x+3=7": [0.02, 1.0],
+        "solve 2x + 3 = 9": [0.0, 1.0],
+    }
+    monkeypatch.setattr(
+        semantic_cache, "_embed",
+        lambda q: np.asarray(vectors[q], dtype=np.float32) / np.linalg.norm(vectors[q]),
+    )
+    return semantic_cache
+
+def test_miss_then_paraphrase_hit(cache):
+    answer, vec = cache.lookup("explain photosynthesis")
+    assert answer is None and vec is not None
+    cache.store("explain photosynthesis", '{"type": "answer"}', vec)
+    assert cache.lookup("how does photosynthesis work") == ('{"type": "answer"}', None)
+
+def test_unrelated_question_misses(cache):
+    _, vec = cache.lookup("explain photosynthesis")
+    cache.store("explain photosynthesis", "cached", vec)
+    answer, vec = cache.lookup("solve 2x + 3 = 7")
+    assert answer is None and vec is not None
+
+def test_matrix_grows_past_initial_capacity(cache, monkeypatch):
+    monkeypatch.setattr(cache, "INITIAL_CAPACITY", 1)
+    _, vec = cache.lookup("explain photosynthesis")
+    cache.store("explain photosynthesis", "photo", vec)
+    _, vec = cache.lookup("solve 2x + 3 = 7")
+    cache.store("solve 2x + 3 = 7", "algebra", vec)
+    assert cache.lookup("solve 2x + 3 = 7") == ("algebra", None)
+    assert cache.lookup("how does photosynthesis work") == ("photo", None)
+
+def test_oldest_entry_evicted_when_full(cache, monkeypatch):
+    monkeypatch.setattr(cache, "MAX_ENTRIES", 1)
+    _, vec = cache.lookup("explain photosynthesis")
+    cache.store("explain photosynthesis", "photo", vec)
+    _, vec = cache.lookup("solve 2x + 3 = 7")
+    cache.store("solve 2x + 3 = 7", "algebra", vec)
+    assert cache._answers == ["algebra"]
+    answer, _ = cache.lookup("explain photosynthesis")
+    assert answer is None
+
+def test_expired_entry_not_served(cache, monkeypatch):
+    _, vec = cache.lookup("explain photosynthesis")
+    cache.store("explain photosynthesis", "photo", vec)
+    later = time.time() + cache.TTL_SECONDS + 60
+    monkeypatch.setattr(cache.time, "time", lambda: later)
+    answer, vec = cache.lookup("how does photosynthesis work")
+    assert answer is None and vec is not None
+    assert cache._answers == []
+
+def test_numbers_must_match(cache):
+    _, vec = cache.lookup("solve 2x + 3 = 7")
+    cache.store("solve 2x + 3 = 7", "x = 2", vec)
+    answer, vec = cache.lookup("solve 2x + 3 = 9")
+    assert answer is None and vec is not None
+    assert cache.lookup("Solve 2x+3=7") == ("x = 2", None)
@@ -0,0 +1,24 @@
+import orjson
+import pytest
+
+import user_memory
+
+
+@pytest.fixture
+def memory(tmp_path, monkeypatch):
+    legacy = tmp_path / "user_data.json"
+    legacy.write_bytes(orjson.dumps({"u1": {"name": "Ada"}}))
+    monkeypatch.setattr(user_memory, "DATA_FILE", str(legacy))
+    monkeypatch.setattr(user_memory, "DB_FILE", str(tmp_path / "user_data.db"))
+    monkeypatch.setattr(user_memory, "_conn", None)
+    yield user_memory
+    if user_memory._conn is not None:
+        user_memory._conn.close()
+
+
+def test_legacy_file_imported_once(memory, monkeypatch):
+    assert memory.get_user_profile("u1") == {"name": "Ada"}
+    memory.save_user_data({})
+    memory._conn.close()
+    monkeypatch.setattr(memory, "_conn", None)
+    assert memory.load_user_data() == {}
@@ -1,35 +1,85 @@
-import json
 import os
+import sqlite3
+import threading
+
+import orjson
+
+DATA_FILE = "user_data.json"  # legacy store, imported once into DB_FILE
+DB_FILE = os.getenv("USER_MEMORY_DB", "user_data.db")
+
+_lock = threading.Lock()
+_conn = None
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, data TEXT)")
+        # user_version records that the legacy import has run, so profiles
+        # deleted later are not brought back from the old JSON file
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            if os.path.exists(DATA_FILE):
+                with open(DATA_FILE, "rb") as f:
+                    legacy = orjson.loads(f.read())
+                conn.executemany(
+                    "INSERT OR IGNORE INTO profiles (user_id, data) VALUES (?, ?)",
+                    [(user_id, orjson.dumps(profile)) for user_id, profile in legacy.items()],
+                )
+            conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _save_profile(conn, user_id, profile):
+    conn.execute(
+        "INSERT OR REPLACE INTO profiles (user_id, data) VALUES (?, ?)",
+        (user_id, orjson.dumps(profile)),
+    )
+    conn.commit()
 
-DATA_FILE = "user_data.json"
 
 def load_user_data():
-    if not os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "w") as f:
-            json.dump({}, f)
-    with open(DATA_FILE, "r") as f:
-        return json.load(f)
+    with _lock:
+        rows = _connect().execute("SELECT user_id, data FROM profiles").fetchall()
+    return {user_id: orjson.loads(data) for user_id, data in rows}
+
 
 def save_user_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+    with _lock:
+        conn = _connect()
+        conn.execute("DELETE FROM profiles")
+        conn.executemany(
+            "INSERT INTO profiles (user_id, data) VALUES (?, ?)",
+            [(user_id, orjson.dumps(profile)) for user_id, profile in data.items()],
+        )
+        conn.commit()
+
 
 def get_user_profile(user_id):
-    data = load_user_data()
-    return data.get(user_id, {})
+    with _lock:
+        row = _connect().execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+    return orjson.loads(row[0]) if row else {}
+
 
 def update_user_profile(user_id, key, value):
-    data = load_user_data()
-    if user_id not in data:
-        data[user_id] = {}
-    data[user_id][key] = value
-    save_user_data(data)
+    with _lock:
+        conn = _connect()
+        row = conn.execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        profile = orjson.loads(row[0]) if row else {}
+        profile[key] = value
+        _save_profile(conn, user_id, profile)
+
 
 def add_message_to_history(user_id, message):
-    data = load_user_data()
-    if user_id not in data:
-        data[user_id] = {}
-    history = data[user_id].get("history", [])
-    history.append({"message": message})
-    data[user_id]["history"] = history[-10:]  # Keep last 10 messages only
-    save_user_data(data)
\ No newline at end of file
+    with _lock:
+        conn = _connect()
+        row = conn.execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        profile = orjson.loads(row[0]) if row else {}
+        history = profile.get("history", [])
+        history.append({"message": message})
+        profile["history"] = history[-10:]  # Keep last 10 messages only
+        _save_profile(conn, user_id, profile)